@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
-import requests
 import sqlite3
+import sys
 from datetime import datetime, timedelta
-from collections import defaultdict
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 import json
-import os
+import atexit
+import heapq
+import operator
 
 # SQLite database paths (from config.yaml)
 DB_PATH = "data/bot.db"  # Main user database
@@ -17,52 +18,140 @@ TRANSACTIONS_PATH = "data/transactions.db"  # Transactions database
 #    "Content-type": "application/json"
 #}
 
+# Persistent connections, opened lazily and reused across queries
+_CONN_TX = None
+_CONN_USERS = None
+
+def _connect(path: str, label: str) -> Optional[sqlite3.Connection]:
+    """Open a read-only connection to the given database and tune it for reads"""
+    # mode=ro makes a missing file an error instead of creating an empty one.
+    # It also rules out any maintenance (CREATE INDEX, ANALYZE, PRAGMA optimize)
+    # on the shared connection; writes go through _ensure_index instead.
+    try:
+        conn = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False, isolation_level=None
+        )
+    except sqlite3.OperationalError:
+        print(f"Error: {label} database not found at {path}")
+        return None
+    try:
+        # Per-connection read tuning only; journal mode is left to the bot
+        conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+        conn.execute("PRAGMA cache_size=-65536")  # 64MB
+        conn.execute("PRAGMA temp_store=MEMORY")
+    except sqlite3.Error as e:
+        conn.close()
+        print(f"Error opening {label} database at {path}: {e}")
+        return None
+    return conn
+
+def _ensure_index(conn: sqlite3.Connection, path: str, name: str, sql: str) -> None:
+    """Create a supporting index once; failing to do so is not fatal"""
+    try:
+        if conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)
+        ).fetchone():
+            return
+        # The shared connection is read-only, so write through a short-lived one
+        writer = sqlite3.connect(f"file:{path}?mode=rw", uri=True, isolation_level=None)
+        try:
+            writer.execute(sql)
+            # Only the new index needs statistics, not the whole database
+            writer.execute(f"ANALYZE {name}")
+        finally:
+            writer.close()
+    except sqlite3.Error as e:
+        # The bot may hold the write lock or the file may be read-only;
+        # the queries still work without the index
+        print(f"Warning: could not create index {name}: {e}")
+
+def _get_tx_conn() -> Optional[sqlite3.Connection]:
+    """Get the shared connection to the transactions database"""
+    global _CONN_TX
+    if _CONN_TX is None:
+        conn = _connect(TRANSACTIONS_PATH, "Transactions")
+        if conn is None:
+            return None
+        _ensure_index(
+            conn,
+            TRANSACTIONS_PATH,
+            "idx_tx_type_time",
+            "CREATE INDEX idx_tx_type_time ON transactions(type, time) WHERE success = 1",
+        )
+        _CONN_TX = conn
+    return _CONN_TX
+
+def _get_users_conn() -> Optional[sqlite3.Connection]:
+    """Get the shared connection to the user database"""
+    global _CONN_USERS
+    if _CONN_USERS is None:
+        conn = _connect(DB_PATH, "User")
+        if conn is None:
+            return None
+        # `name` is the primary key, so only the username needs an index
+        _ensure_index(
+            conn,
+            DB_PATH,
+            "idx_users_tg",
+            "CREATE INDEX idx_users_tg ON users(telegram_username)",
+        )
+        _CONN_USERS = conn
+    return _CONN_USERS
+
+def _close_connections():
+    """Close the shared connections"""
+    for conn in (_CONN_TX, _CONN_USERS):
+        if conn is not None:
+            conn.close()
+
+atexit.register(_close_connections)
+
+def _one_week_ago() -> str:
+    """Cutoff for the stats window, in the format the bot stores `time` in"""
+    # The bot stores `time` as text ("YYYY-MM-DD HH:MM:SS..."), so compare
+    # against a plain string in the same format to keep the index usable.
+    return (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
+
 def get_transactions_from_sqlite() -> List[Dict]:
-    """Get all faucet transactions from the local SQLite database"""
-    if not os.path.exists(TRANSACTIONS_PATH):
-        print(f"Error: Transactions database not found at {TRANSACTIONS_PATH}")
+    """
+    Get all faucet transactions from the local SQLite database.
+    Not used by the stats below, which aggregate in SQL; kept as a public
+    helper for other tools that need the individual rows.
+    """
+    conn = _get_tx_conn()
+    if conn is None:
         return []
-        
-    conn = sqlite3.connect(TRANSACTIONS_PATH)
-    conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
     
     # Get transactions from the last week where type is 'faucet'
-    twelve_months_ago = int((datetime.now() - timedelta(days=7)).timestamp())
+    one_week_ago = _one_week_ago()
     query = """
     SELECT 
         from_user as sender,
         to_user as recipient,
         amount,
-        time,
-        type,
-        success,
-        memo
+        type
     FROM transactions 
     WHERE type = 'faucet' 
     AND success = 1 
-    AND time >= datetime(?, 'unixepoch')
+    AND time >= ?
     """
     
     try:
-        cursor.execute(query, (twelve_months_ago,))
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        cursor.execute(query, (one_week_ago,))
+        return [dict(row) for row in cursor.fetchall()]
     except sqlite3.Error as e:
         print(f"Error querying SQLite database: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_user_info_from_sqlite(user_id: str) -> Optional[Dict]:
     """Get user information from the local SQLite database"""
-    if not os.path.exists(DB_PATH):
-        print(f"Error: User database not found at {DB_PATH}")
+    conn = _get_users_conn()
+    if conn is None:
         return None
-        
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
     
     try:
         cursor.execute("""
@@ -80,50 +169,106 @@ def get_user_info_from_sqlite(user_id: str) -> Optional[Dict]:
     except sqlite3.Error as e:
         print(f"Error querying SQLite database: {e}")
         return None
-    finally:
-        conn.close()
+
+# Ids per IN query; each id is bound twice, which keeps a batch under
+# SQLite's historical limit of 999 variables per statement
+_USER_BATCH_SIZE = 400
+
+def get_user_info_many(user_ids: List[str]) -> Dict[str, Dict]:
+    """
+    Get user information for several users with one query per batch of ids.
+    Ids may be names or telegram usernames; a row matching one id by name and
+    another by telegram username is returned under both keys.
+    """
+    if not user_ids:
+        return {}
+    conn = _get_users_conn()
+    if conn is None:
+        return {}
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    
+    wanted = set(user_ids)
+    users = {}
+    try:
+        for start in range(0, len(user_ids), _USER_BATCH_SIZE):
+            batch = user_ids[start:start + _USER_BATCH_SIZE]
+            q = ",".join("?" * len(batch))
+            cursor.execute(f"""
+                SELECT 
+                    name,
+                    telegram_username,
+                    wallet_id,
+                    wallet_name,
+                    wallet_balance
+                FROM users 
+                WHERE name IN ({q}) OR telegram_username IN ({q})
+            """, (*batch, *batch))
+            for row in cursor:
+                for key in (row["name"], row["telegram_username"]):
+                    if key in wanted:
+                        users[key] = dict(row)
+        return users
+    except sqlite3.Error as e:
+        print(f"Error querying SQLite database: {e}")
+        return {}
 
 def analyze_faucet_transactions() -> tuple[Dict[str, int], Dict[str, int], Dict[str, int]]:
     """
     Analyze faucet transactions to get:
     1. Total amount distributed per user
     2. Total amount received per user
-    Combines data from both SQLite and LNbits API
+    3. Balance per user (distributed - received)
+    Aggregation is done by SQLite, one row per user
     """
-    # Track distributions and receipts
-    distributions = defaultdict(int)  # username -> total amount
-    receipts = defaultdict(int)      # username -> total amount
-    balance = defaultdict(int)       # username -> total amount
+    conn = _get_tx_conn()
+    if conn is None:
+        return {}, {}, {}
     
-    # Get transactions from SQLite
-    transactions = get_transactions_from_sqlite()
+    one_week_ago = _one_week_ago()
+    try:
+        # Read both aggregates from a single snapshot
+        conn.execute("BEGIN")
+        # Total amount distributed per sender
+        distributions = dict(conn.execute("""
+            SELECT from_user, SUM(amount)
+            FROM transactions
+            WHERE type = 'faucet' AND success = 1 AND time >= ?
+            GROUP BY from_user
+        """, (one_week_ago,)))
+        # Total amount received per recipient
+        receipts = dict(conn.execute("""
+            SELECT to_user, SUM(amount)
+            FROM transactions
+            WHERE type = 'faucet' AND success = 1 AND time >= ?
+            GROUP BY to_user
+        """, (one_week_ago,)))
+        conn.execute("COMMIT")
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        print(f"Error querying SQLite database: {e}")
+        return {}, {}, {}
     
-    for tx in transactions:
-        # Skip failed transactions
-        if not tx['success']:
-            continue
-            
-        # Get sender and recipient usernames
-        sender = tx['sender']
-        recipient = tx['recipient']
-        amount = tx['amount']
-        
-        if "faucet" in tx['type'].lower():
-            distributions[sender] += amount
-            receipts[recipient] += amount
-            balance[sender] += amount
-            balance[recipient] += -amount
+    balance = dict(distributions)
+    for username, amount in receipts.items():
+        balance[username] = balance.get(username, 0) - amount
     
-    return dict(distributions), dict(receipts), dict(balance)
+    return distributions, receipts, balance
 
-def format_stats(stats: Dict[str, int], title: str) -> str:
-    """Format statistics for display"""
-    result = [f"\n{title}:"]
-    for username, amount in sorted(stats.items(), key=lambda x: x[1], reverse=True):
-        # Convert amount from sats to BTC for readability
-        sats = amount
-        result.append(f"  {username}: {sats:,.0f} sats")
-    return "\n".join(result)
+def emit_stats(stats: Dict[str, int], title: str, top_n: Optional[int] = 50, out: Optional[Callable[[str], object]] = None) -> None:
+    """Write the top_n users (all if None) of the statistics for display, line by line"""
+    # Resolve stdout at call time so redirect_stdout is honoured
+    out = out or sys.stdout.write
+    by_amount = operator.itemgetter(1)
+    if top_n is None or len(stats) <= top_n:
+        rows = sorted(stats.items(), key=by_amount, reverse=True)
+        out(f"\n{title}:\n")
+    else:
+        rows = heapq.nlargest(top_n, stats.items(), key=by_amount)
+        out(f"\n{title} (top {top_n} of {len(stats)} users):\n")
+    for username, amount in rows:
+        out(f"  {username}: {amount:,.0f} sats\n")
 
 def main():
     print("Fetching faucet statistics...")
@@ -135,9 +280,10 @@ def main():
     print("\nFaucet Statistics for the Last 7 Days:")
     print("-" * 50)
     
-    print(format_stats(distributions, "Total Amount Distributed per User of last 7 days"))
-    print(format_stats(receipts, "Total Amount Received per User of last 7 days"))
-    print(format_stats(balance, "Balance of Faucets per User of last 7 days (negative = lurker)"))
+    emit_stats(distributions, "Total Amount Distributed per User of last 7 days")
+    emit_stats(receipts, "Total Amount Received per User of last 7 days")
+    # Show every user here, the lurkers are at the bottom of the list
+    emit_stats(balance, "Balance of Faucets per User of last 7 days (negative = lurker)", top_n=None)
 
-# Run
-main()
+if __name__ == "__main__":
+    main()